@@ -0,0 +1,340 @@
+import gc
+import os
+import sys
+import csv
+import json
+import timeit
+import click
+import random
+import logging
+import resource
+import tempfile
+import statistics
+import multiprocessing
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from payroll import Payroll
+
+
+PAY_FREQUENCIES = ["weekly", "biweekly", "semimonthly"]
+
+SUBTYPES = [
+    "employer_provided_vehicle",
+    "restricted_stock_vesting",
+    "housing_allowance",
+    "moving_expenses",
+]
+
+# Timings of a single helper call in a loop drift the most between runs
+MICRO_METRICS = ["parse_amount_rows_per_sec", "get_payment_date_rows_per_sec"]
+
+
+def generate_fixtures(members, dates_per_frequency=3, seed=0):
+    """ Build fake `members`, `upcomingPayDates` and `fringeBenefitsSubtypes` """
+    rnd = random.Random(seed)
+
+    employees = [
+        {
+            "name": "Member %06d" % i,
+            "uuid": "%032x" % rnd.getrandbits(128),
+            "payable": True,
+            "current_member_state": {"pay_frequency": rnd.choice(PAY_FREQUENCIES)},
+        }
+        for i in range(members)
+    ]
+
+    today = date.today()
+    payment_dates = {}
+    for frequency in PAY_FREQUENCIES:
+        days = [today + timedelta(days=7 * (i + 1)) for i in range(dates_per_frequency)]
+        # the site returns dates unordered and the nearest one is often disabled
+        rnd.shuffle(days)
+        payment_dates[frequency] = [
+            {
+                "value": day.isoformat(),
+                "description": day.strftime("%B %d"),
+                "disabled": day == today + timedelta(days=7),
+            }
+            for day in days
+        ]
+
+    fringe_benefits_subtypes = [
+        {"value": st, "description": st.replace("_", " ").capitalize()}
+        for st in SUBTYPES
+    ]
+
+    return employees, payment_dates, fringe_benefits_subtypes
+
+
+def generate_csv(csv_file_path, employees, rows, seed=0):
+    """ Write a payroll CSV with `rows` valid payments for the given employees """
+    rnd = random.Random(seed)
+    with open(csv_file_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(Payroll.source_csv_columns)
+        for i in range(rows):
+            writer.writerow(
+                [
+                    rnd.choice(employees)["name"],
+                    "{:.2f}".format(rnd.uniform(1, 10000)),
+                    rnd.choice(SUBTYPES),
+                    "Code%d" % i,
+                ]
+            )
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def best_time(func, repeat):
+    """ Best time of a single `func` call, each run lasting at least 0.2s """
+    func()  # warm up
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_scenario(rows, members, repeat, work_dir):
+    employees, payment_dates, subtypes = generate_fixtures(members)
+    csv_file_path = os.path.join(work_dir, "payroll_%d_%d.csv" % (rows, members))
+    generate_csv(csv_file_path, employees, rows)
+
+    def new_payroll():
+        return Payroll(
+            employees=employees,
+            payment_dates=payment_dates,
+            fringe_benefits_subtypes=subtypes,
+            request_id="bench",
+        )
+
+    def load():
+        payroll = new_payroll()
+        assert payroll.load_from_csv(csv_file_path)
+        return payroll
+
+    payroll = load()
+    payment_rows = [
+        {"name": p["name"], "amount": str(p["amount"]), "type": p["subtype"]}
+        for p in payroll.payments
+    ]
+    pay_frequencies = [
+        e["current_member_state"]["pay_frequency"] for e in employees
+    ] * (rows // members + 1)
+    pay_frequencies = pay_frequencies[:rows]
+
+    def parse_amounts():
+        for payment_data in payment_rows:
+            payroll._parse_amount(payment_data)
+
+    def get_payment_dates():
+        for pay_frequency in pay_frequencies:
+            payroll._get_payment_date(pay_frequency)
+
+    devnull = open(os.devnull, "w")
+
+    def print_payments():
+        with redirect_stdout(devnull):
+            payroll.print_payments(devnull)
+
+    result = {
+        "rows": rows,
+        "members": members,
+        "load_from_csv_rows_per_sec": rows / best_time(load, repeat),
+        "parse_amount_rows_per_sec": rows / best_time(parse_amounts, repeat),
+        "get_payment_date_rows_per_sec": rows / best_time(get_payment_dates, repeat),
+        "print_payments_rows_per_sec": rows / best_time(print_payments, repeat),
+        # read before tracemalloc, which adds its own overhead
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    devnull.close()
+
+    # CPython doesn't count short-lived allocations, so this is the number
+    # of memory blocks load_from_csv leaves allocated, per row
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    loaded = load()
+    gc.collect()
+    blocks_after = sys.getallocatedblocks()
+    result["allocated_blocks_per_row"] = (blocks_after - blocks_before) / rows
+    del loaded
+
+    # Memory is traced in a separate pass, tracemalloc skews timings
+    tracemalloc.start()
+    load()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result["peak_traced_bytes_per_row"] = traced_peak / rows
+    return result
+
+
+def run_scenario_isolated(rows, members, repeat, work_dir):
+    """ Run the scenario in a fresh process, so peak RSS is its own """
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(run_scenario, (rows, members, repeat, work_dir))
+
+
+def median_result(results):
+    """ Median of every metric over results of independent runs """
+    return {
+        metric: statistics.median(result[metric] for result in results)
+        for metric in results[0]
+    }
+
+
+def compare(result, baseline, tolerance, micro_tolerance):
+    """ Return a list of metrics that regressed more than allowed """
+    regressions = []
+    for metric, value in result.items():
+        if metric in ("rows", "members") or metric not in baseline:
+            continue
+        base = baseline[metric]
+        allowed = micro_tolerance if metric in MICRO_METRICS else tolerance
+        if metric.endswith("_per_sec"):
+            regressed = value < base * (1 - allowed)
+        else:
+            regressed = value > base * (1 + allowed)
+        if regressed:
+            regressions.append((metric, base, value))
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--rows",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[1000, 10000, 100000],
+    show_default=True,
+    help="CSV row count, can be repeated.",
+)
+@click.option(
+    "--members",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Members count.",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=5,
+    show_default=True,
+    help="Timed runs per measurement.",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=5,
+    show_default=True,
+    help="Fresh processes per scenario, results are their median.",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False),
+    default="bench_baseline.json",
+    show_default=True,
+    help="Baseline results file.",
+)
+@click.option(
+    "--save-baseline", default=False, is_flag=True, help="Store results as baseline."
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=0.2,
+    show_default=True,
+    help="Allowed relative regression.",
+)
+@click.option(
+    "--micro-tolerance",
+    type=click.FloatRange(min=0),
+    default=0.5,
+    show_default=True,
+    help="Allowed relative regression of %s." % ", ".join(MICRO_METRICS),
+)
+def main(
+    rows, members, repeat, processes, baseline, save_baseline, tolerance, micro_tolerance
+):
+    """Benchmark payroll CSV ingest on synthetic data
+    and compare the results with a stored baseline.
+
+    Exits with a non-zero status if any metric regressed
+    or there is no baseline to compare with.
+    """
+
+    baseline_data = {}
+    if os.path.exists(baseline):
+        with open(baseline) as baseline_file:
+            baseline_data = json.load(baseline_file)
+
+    if not save_baseline and not baseline_data:
+        click.secho(
+            "No baseline found: %s, run with --save-baseline first" % baseline,
+            fg="bright_red",
+        )
+        sys.exit(1)
+
+    scenarios = {"%dx%d" % (row_count, members): row_count for row_count in rows}
+    runs = {key: [] for key in scenarios}
+
+    # Scenarios are interleaved, so a noisy moment doesn't hit only one of them
+    with tempfile.TemporaryDirectory() as work_dir:
+        for process in range(processes):
+            click.secho("Run %d/%d" % (process + 1, processes))
+            for key, row_count in scenarios.items():
+                runs[key].append(
+                    run_scenario_isolated(row_count, members, repeat, work_dir)
+                )
+
+    results = {}
+    failed = False
+
+    for key in scenarios:
+        click.secho("\nScenario: %s" % key, fg="bright_blue")
+
+        result = median_result(runs[key])
+        results[key] = result
+
+        for metric, value in result.items():
+            click.secho("  {:<32s}{:>14.1f}".format(metric, value))
+
+        if save_baseline:
+            continue
+
+        if key not in baseline_data:
+            failed = True
+            click.secho("  No baseline for this scenario", fg="bright_red")
+            continue
+
+        for metric, base, value in compare(
+            result, baseline_data[key], tolerance, micro_tolerance
+        ):
+            failed = True
+            click.secho(
+                "  REGRESSION {}: {:.1f} -> {:.1f}".format(metric, base, value),
+                fg="bright_red",
+            )
+
+    if save_baseline:
+        # Keep the scenarios that were not run this time
+        baseline_data.update(results)
+        with open(baseline, "w") as baseline_file:
+            json.dump(baseline_data, baseline_file, indent=2, sort_keys=True)
+        click.secho("\nBaseline saved: %s" % baseline, fg="green")
+
+    if failed:
+        click.secho("\nPerformance check failed.", fg="bright_red")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s: %(message)s", level=logging.INFO,
+    )
+    main()
@@ -3,6 +3,8 @@ import sys
 import json
 import pyotp
 import requests
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
 import logging
 
@@ -21,6 +23,12 @@ class API:
 
     session_max_age = 300
 
+    # A rejected csrf token makes Rails render its generic 422 response,
+    # JSON or the public HTML page depending on the requested format.
+    # Errors rendered by the app itself carry their own details instead.
+    csrf_rejected_json = {"status": 422, "error": "Unprocessable Entity"}
+    csrf_rejected_html = "The change you wanted was rejected."
+
     headers = {
         "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_2) "
         "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -33,8 +41,16 @@ class API:
         self.username = username
         self.password = password
         self.s = requests.Session()
-        self.s.headers = self.headers
+        self.s.headers = dict(self.headers)
         self.session_updated_at = datetime.min
+        self.session_lock = threading.RLock()
+        self.session_renew_failed = False
+
+        # Renewal rewrites cookies and the csrf header of the shared session,
+        # so it waits for requests in flight and holds off new ones
+        self.requests_cv = threading.Condition()
+        self.requests_in_flight = 0
+        self.requests_paused = False
 
         self.employees = None
         self.payment_dates = None
@@ -45,19 +61,70 @@ class API:
         mtc = rx.search(text)
         return json.loads(mtc.group(1))
 
-    def poke_session(self):
+    def session_expired(self):
         session_age = datetime.now() - self.session_updated_at
-        if session_age.total_seconds() > self.session_max_age:
-            self.renew_session()
-        else:
+        return session_age.total_seconds() > self.session_max_age
+
+    @contextmanager
+    def session_request(self):
+        """ Keep the session unchanged while a request is in flight """
+        with self.requests_cv:
+            self.requests_cv.wait_for(lambda: not self.requests_paused)
+            self.requests_in_flight += 1
+        try:
+            yield
+        finally:
+            with self.requests_cv:
+                self.requests_in_flight -= 1
+                self.requests_cv.notify_all()
+
+    @contextmanager
+    def session_exclusive(self):
+        """ Wait for requests in flight to finish and hold off new ones """
+        with self.requests_cv:
+            self.requests_paused = True
+            self.requests_cv.wait_for(lambda: self.requests_in_flight == 0)
+        try:
+            yield
+        finally:
+            with self.requests_cv:
+                self.requests_paused = False
+                self.requests_cv.notify_all()
+
+    def request(self, method, url, **kwargs):
+        with self.session_request():
+            return self.s.request(method, url, **kwargs)
+
+    def poke_session(self):
+        if not self.session_expired():
             logger.info("Use old session")
+            return
+        with self.session_lock:
+            if self.session_renew_failed:
+                logger.error("Session renewal failed, not trying again")
+                sys.exit()
+            # Another thread may have renewed the session while we were waiting
+            if self.session_expired():
+                self.renew_session()
+            else:
+                logger.info("Use old session")
 
     def renew_session(self):
-        logger.info("Renew session")
-        self.update_csrf_token()
-        self.authenticate()
-        self.bypass_otp()
-        self.session_updated_at = datetime.now()
+        with self.session_lock, self.session_exclusive():
+            logger.info("Renew session")
+            try:
+                # The login form needs a token, and sign in rotates it afterwards
+                self.update_csrf_token()
+                self.authenticate()
+                self.bypass_otp()
+                self.update_csrf_token()
+            except BaseException:
+                # sys.exit() only ends the current thread, so make sure
+                # the waiting ones don't log in again one after another
+                self.session_renew_failed = True
+                raise
+            self.session_renew_failed = False
+            self.session_updated_at = datetime.now()
 
     def authenticate(self):
         logger.info("Authenticate user")
@@ -93,9 +160,39 @@ class API:
         csrf_token = self.parse_hydration_data(response.text, "form_authenticity_token")
         self.s.headers.update({"x-csrf-token": csrf_token})
 
+    def refresh_csrf_token(self, rejected_token):
+        with self.session_lock, self.session_exclusive():
+            # Only the first thread to see the rejection fetches a new token
+            if self.s.headers.get("x-csrf-token") == rejected_token:
+                self.update_csrf_token()
+
+    def csrf_rejected(self, response):
+        if response.status_code != 422:
+            return False
+        try:
+            return response.json() == self.csrf_rejected_json
+        except ValueError:
+            return self.csrf_rejected_html in response.text
+
+    def post_with_csrf(self, url, **kwargs):
+        """ POST and retry once with a fresh csrf token if it was rejected """
+        csrf_token = self.s.headers.get("x-csrf-token")
+        response = self.request("POST", url, **kwargs)
+        # This replays payment submissions, so only the bare generic 422
+        # response is retried: Rails renders it when the token check, which
+        # runs before the action, fails. Errors rendered by the app carry
+        # details and are returned to the caller as is. The one overlap is
+        # an unhandled RecordInvalid, which renders the same response after
+        # the action has run.
+        if self.csrf_rejected(response):
+            logger.info("Csrf token rejected")
+            self.refresh_csrf_token(csrf_token)
+            response = self.request("POST", url, **kwargs)
+        return response
+
     def get_constants(self):
         self.poke_session()
-        response = self.s.get(FORM_URL, allow_redirects=False)
+        response = self.request("GET", FORM_URL, allow_redirects=False)
         if response.status_code != 200:
             logger.error("Can't get constants: %s" % response.text)
             sys.exit()
@@ -110,7 +207,6 @@ class API:
 
     def create_payments(self, payments):
         self.poke_session()
-        self.update_csrf_token()
 
         formated_payments = []
 
@@ -129,7 +225,7 @@ class API:
 
         # print(json.dumps(payments_data, indent=2, ensure_ascii=False))
 
-        response = self.s.post(FRINGE_BENEFITS_URL, json=payments_data)
+        response = self.post_with_csrf(FRINGE_BENEFITS_URL, json=payments_data)
         if response.status_code == 200:
             return None
         else:
@@ -137,7 +233,6 @@ class API:
 
     def create_bonus_payments(self, payments, pay_date, note):
         self.poke_session()
-        self.update_csrf_token()
 
         allocations = {}
         for payment in payments:
@@ -162,7 +257,7 @@ class API:
         }
         print(json.dumps(payments_data, indent=2, ensure_ascii=False))
 
-        response = self.s.post(BONUS_URL, json=payments_data)
+        response = self.post_with_csrf(BONUS_URL, json=payments_data)
         if response.status_code == 201:
             return None
         else:
@@ -177,7 +272,7 @@ class API:
             r"</td>\s*<td>([^<]+)</td>\s*<td>([^<]+)</td>\s*<td>\s*<a"
         )
 
-        response = self.s.get(url)
+        response = self.request("GET", url)
         mtcs = rx_payment.findall(response.text)
 
         return [
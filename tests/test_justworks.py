@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+import pytest
+import requests
+
+from justworks import API
+
+
+THREADS = 8
+
+
+def make_response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = body.encode()
+    return response
+
+
+class FakeAPI(API):
+    """ API with the network calls of renew_session replaced by counters """
+
+    def __init__(self, fail_auth=False):
+        super().__init__(username="user", password="secret")
+        self.fail_auth = fail_auth
+        self.calls = []
+
+    def update_csrf_token(self):
+        self.calls.append("csrf")
+        # give the other threads time to pile up on the lock
+        time.sleep(0.05)
+
+    def authenticate(self):
+        self.calls.append("auth")
+        if self.fail_auth:
+            raise SystemExit()
+
+    def bypass_otp(self):
+        self.calls.append("otp")
+
+
+def run_threads(target, count=THREADS):
+    barrier = threading.Barrier(count)
+    exits = []
+
+    def run():
+        barrier.wait()
+        try:
+            target()
+        except SystemExit:
+            exits.append(True)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return exits
+
+
+def test_poke_session_renews_once():
+    api = FakeAPI()
+    exits = run_threads(api.poke_session)
+    assert exits == []
+    assert api.calls.count("auth") == 1
+    assert api.calls.count("otp") == 1
+    assert not api.session_expired()
+
+
+def test_failed_renewal_is_not_repeated():
+    api = FakeAPI(fail_auth=True)
+    exits = run_threads(api.poke_session)
+    assert len(exits) == THREADS
+    assert api.calls.count("auth") == 1
+    assert api.calls.count("otp") == 0
+    assert api.session_updated_at == datetime.min
+
+
+def test_renewal_waits_for_requests_in_flight(monkeypatch):
+    api = FakeAPI()
+    started = threading.Event()
+    release = threading.Event()
+    events = []
+
+    def slow_request(method, url, **kwargs):
+        started.set()
+        release.wait()
+        events.append("request done")
+        return make_response(200, "")
+
+    monkeypatch.setattr(api.s, "request", slow_request)
+
+    def renew():
+        api.renew_session()
+        events.append("renewed")
+
+    request_thread = threading.Thread(target=api.request, args=("GET", "url"))
+    request_thread.start()
+    started.wait()
+
+    renew_thread = threading.Thread(target=renew)
+    renew_thread.start()
+    time.sleep(0.1)
+    assert api.calls == []
+
+    release.set()
+    request_thread.join()
+    renew_thread.join()
+    assert events == ["request done", "renewed"]
+
+
+@pytest.mark.parametrize(
+    "status_code, body, rejected",
+    [
+        (422, json.dumps({"status": 422, "error": "Unprocessable Entity"}), True),
+        (422, "<h1>The change you wanted was rejected.</h1>", True),
+        (422, json.dumps({"errors": {"amount": ["is invalid"]}}), False),
+        (422, "Validation failed", False),
+        (403, "The change you wanted was rejected.", False),
+        (200, "", False),
+    ],
+)
+def test_csrf_rejected(status_code, body, rejected):
+    api = FakeAPI()
+    assert api.csrf_rejected(make_response(status_code, body)) is rejected
+
+
+@pytest.mark.parametrize(
+    "first_response, posts",
+    [
+        (make_response(422, '{"status": 422, "error": "Unprocessable Entity"}'), 2),
+        (make_response(422, '{"errors": {"amount": ["is invalid"]}}'), 1),
+        (make_response(403, "Forbidden"), 1),
+    ],
+)
+def test_post_with_csrf_retries_only_csrf_rejection(
+    monkeypatch, first_response, posts
+):
+    api = FakeAPI()
+    responses = [first_response, make_response(200, "")]
+    sent = []
+
+    def fake_request(method, url, **kwargs):
+        sent.append(method)
+        return responses[len(sent) - 1]
+
+    monkeypatch.setattr(api.s, "request", fake_request)
+
+    response = api.post_with_csrf("url", json={})
+    assert len(sent) == posts
+    assert response is responses[posts - 1]
+    assert api.calls.count("csrf") == posts - 1